@@ -9,9 +9,12 @@ import json
 import time
 import threading
 import queue
+import collections
+import selectors
 import subprocess
 import base64
 import re
+import functools
 from ansible.plugins.connection import ConnectionBase
 from ansible.module_utils._text import to_bytes, to_text
 from ansible.errors import AnsibleConnectionFailure
@@ -22,6 +25,66 @@ display = Display()
 # Разделитель для вывода между командами
 WINBATCH_V3_MARKER = '---WINBATCH_V3_COMMAND_DONE---'
 
+# Обёртка команды для REPL: сама команда и номер маркера подставляются через %b/%d.
+# Маркер пишется и в stdout, и в stderr, чтобы оба канала делились по командам
+_WRAP_TMPL = (
+    '$exitCode = 0; try { %b } catch { Write-Error $_.Exception.Message; $exitCode = 1 }; '
+    'Write-Output "' + WINBATCH_V3_MARKER + ':%d:$exitCode"; '
+    '[Console]::Error.WriteLine("' + WINBATCH_V3_MARKER + ':%d:$exitCode")\n'
+).encode()
+
+# Многострочная команда сворачивается в одну строку за один проход
+_CMD_TRANS = str.maketrans({'\n': '; ', '\r': None})
+
+# Один проход regex на строку stdout: маркер конца команды (группа 1, номер и код возврата)
+# либо пустая строка. В режиме -Command - PowerShell не печатает приглашений и не повторяет ввод,
+# поэтому остальные строки - вывод команды, даже если в них встречается текст вроде 'PS ' или 'try {'
+_LINE_RE = re.compile(
+    rb'^(?:(' + re.escape(WINBATCH_V3_MARKER.encode()) + rb')(?::(?P<seq>\d+):(?P<rc>\d+))?|$)'
+)
+
+# Маркер в stderr ищется в любом месте строки: вывод команды без перевода строки склеивается с ним.
+# Номер и код возврата обязательны, иначе маркером окажется текст обёртки, процитированный в ошибке PowerShell
+_ERR_MARKER_RE = re.compile(re.escape(WINBATCH_V3_MARKER.encode()) + rb':(?P<seq>\d+):(?P<rc>\d+)')
+
+# Размер блока чтения из каналов SSH
+_READ_CHUNK = 65536
+
+# Компактный JSON для статусных сообщений
+_JSON_ENC = json.JSONEncoder(separators=(',', ':')).encode
+
+# Передача файлов: 48 КиБ на команду (64 КиБ в base64), до 16 команд за один проход
+_TRANSFER_CHUNK = 48 * 1024
+_TRANSFER_WINDOW = 16
+
+# Каталог сокетов ControlMaster этого плагина. С ssh-соединениями Ansible он не общий:
+# их сокеты лежат в control_path_dir из ansible.cfg и называются по другому шаблону
+WINBATCH_V3_CONTROL_DIR = os.path.expanduser('~/.ansible/cp')
+
+# Общие опции SSH: все подключения к хосту идут через один мастер-сокет
+_COMMON_SSH_OPTS = (
+    '-o', 'StrictHostKeyChecking=no',
+    '-o', 'UserKnownHostsFile=/dev/null',
+    '-o', 'LogLevel=ERROR',
+    '-o', 'ControlMaster=auto',
+    '-o', 'ControlPersist=600s',
+    # %C - хэш хоста, порта и пользователя: путь сокета не упирается в лимит sun_path
+    '-o', f'ControlPath={WINBATCH_V3_CONTROL_DIR}/%C',
+    '-o', 'ServerAliveInterval=30',
+)
+
+@functools.lru_cache(maxsize=256)
+def _ssh_argv(user, host, port, key):
+    """Return the static ssh argv prefix for a target, shared across Connection instances."""
+    argv = ['ssh', '-T', *_COMMON_SSH_OPTS]
+    # Без явного порта действует Port из ~/.ssh/config
+    if port:
+        argv.extend(['-p', str(port)])
+    if key:
+        argv.extend(['-i', key])
+    argv.append(f'{user}@{host}')
+    return tuple(argv)
+
 class Connection(ConnectionBase):
     """WinBatch V3 connection plugin for persistent SSH connection."""
 
@@ -36,26 +99,43 @@ class Connection(ConnectionBase):
         if val is not None:
             try:
                 return int(val)
-            except Exception:
+            except (TypeError, ValueError):
                 return default
         return default
 
     def __init__(self, play_context, new_stdin, *args, **kwargs):
         super(Connection, self).__init__(play_context, new_stdin, *args, **kwargs)
         self._connected = False
+        self._closing = False
         self._ssh_process = None
-        self._command_queue = queue.Queue()
+        self._selector = None
+        self._stdin_buf = bytearray()
+        self._stdout_buf = bytearray()
+        self._stderr_buf = bytearray()
+        self._stderr_open = False
+        self._command_queue = collections.deque()
+        self._command_event = threading.Event()
         self._result_queue = queue.Queue()
-        self._status_thread = None
-        self._last_status_time = time.time()
+        self._seq = 0
         self._status_interval = 10  # seconds
-        self._playbook_start_time = time.time()
+        # Уровень -vvv фиксируем один раз, чтобы не форматировать отладочные строки впустую
+        self._vvv = display.verbosity >= 3
+        self._playbook_start_time = time.monotonic()
+        self._last_status_time = self._playbook_start_time
         
         # Получаем таймауты из vars/play_context
         self._playbook_timeout = self._get_var('playbook_timeout', 45)
         self._command_timeout = self._get_var('command_timeout', 30)
         self._queue_timeout = self._get_var('queue_timeout', 1)
-        self._ps_prompt_regex = re.compile(r'PS [A-Z]:\\.*>')
+
+        # Кэшируем параметры подключения из play_context
+        self._remote_addr = self._play_context.remote_addr
+        self._remote_user = self._play_context.remote_user
+        self._port = self._play_context.port
+        self._key = self._play_context.private_key_file or ''
+
+        # Неизменная часть команды SSH; на каждый вызов меняется только удалённая команда
+        self._ssh_prefix = _ssh_argv(self._remote_user, self._remote_addr, self._port, self._key)
 
     def _connect(self):
         """Establish SSH connection and start command processing thread."""
@@ -63,18 +143,13 @@ class Connection(ConnectionBase):
             return
 
         try:
+            os.makedirs(WINBATCH_V3_CONTROL_DIR, mode=0o700, exist_ok=True)
+
             # Формируем команду SSH
-            ssh_cmd = [
-                'ssh',
-                '-o', 'StrictHostKeyChecking=no',
-                '-o', 'UserKnownHostsFile=/dev/null',
-                '-o', 'ControlMaster=auto',
-                '-o', 'ControlPersist=60s',
-                f'{self._play_context.remote_user}@{self._play_context.remote_addr}',
-                'powershell -NoProfile -NonInteractive'
-            ]
+            ssh_cmd = [*self._ssh_prefix, 'powershell -NoLogo -NoProfile -NonInteractive -Command -']
 
-            # Запускаем SSH процесс
+            # Запускаем SSH процесс. Все три канала обслуживаются напрямую через os.read/os.write
+            # по дескрипторам, файловые объекты Popen для ввода-вывода не используются
             self._ssh_process = subprocess.Popen(
                 ssh_cmd,
                 stdin=subprocess.PIPE,
@@ -83,141 +158,320 @@ class Connection(ConnectionBase):
                 bufsize=0
             )
 
+            # Неблокирующий ввод-вывод через selectors (epoll в Linux); stdin регистрируется
+            # на запись только пока есть неотправленные команды
+            self._stdin_fd = self._ssh_process.stdin.fileno()
+            self._stdout_fd = self._ssh_process.stdout.fileno()
+            self._stderr_fd = self._ssh_process.stderr.fileno()
+            self._selector = selectors.DefaultSelector()
+            os.set_blocking(self._stdin_fd, False)
+            for fd in (self._stdout_fd, self._stderr_fd):
+                os.set_blocking(fd, False)
+                self._selector.register(fd, selectors.EVENT_READ)
+            self._stderr_open = True
+
+            # Остатки предыдущего соединения (недописанный ввод, хвосты вывода, сигнал остановки)
+            # не должны попасть в новую сессию PowerShell
+            self._closing = False
+            self._stdin_buf.clear()
+            self._stdout_buf.clear()
+            self._stderr_buf.clear()
+            self._command_queue.clear()
+            self._command_event.clear()
+
             # Запускаем поток обработки команд
             self._command_thread = threading.Thread(target=self._process_commands)
             self._command_thread.daemon = True
             self._command_thread.start()
 
-            # Запускаем поток отправки статуса
-            self._status_thread = threading.Thread(target=self._send_status)
-            self._status_thread.daemon = True
-            self._status_thread.start()
-
             self._connected = True
-            display.vvv("SSH connection established successfully", host=self._play_context.remote_addr)
+            display.vvv("SSH connection established successfully", host=self._remote_addr)
 
         except Exception as e:
             raise AnsibleConnectionFailure(f"Failed to establish SSH connection: {str(e)}")
 
+    def _time_left(self):
+        """Return the seconds left before the playbook timeout."""
+        return self._playbook_start_time + self._playbook_timeout - time.monotonic()
+
+    def _timed_out(self):
+        """Return True once the playbook timeout has been exceeded."""
+        return self._time_left() < 0
+
     def _check_timeout(self):
         """Check if we've exceeded the playbook timeout."""
-        if time.time() - self._playbook_start_time > self._playbook_timeout:
+        if self._timed_out():
             raise AnsibleConnectionFailure(f"Playbook execution timeout exceeded ({self._playbook_timeout} seconds)")
 
+    def _check_closing(self):
+        """Stop the command worker once close() has been called."""
+        if self._closing:
+            raise AnsibleConnectionFailure("Connection is closing")
+
     def _process_commands(self):
-        """Process commands from the queue and execute them on the remote host."""
-        while True:
-            try:
-                self._check_timeout()
-                command = self._command_queue.get(timeout=self._queue_timeout)
-                if command is None:
-                    break
-                display.vvv(f"[winbatch_v3] EXEC: {command}", host=self._play_context.remote_addr)
-                
-                # Формируем команду как одну строку для REPL
-                # Заменяем переводы строк на точку с запятой для многострочных команд
-                single_line_command = command.replace('\n', '; ').replace('\r', '')
-                wrapped_command = f'$exitCode = 0; try {{ {single_line_command} }} catch {{ Write-Error $_.Exception.Message; $exitCode = 1 }}; Write-Output "{WINBATCH_V3_MARKER}:$exitCode"'
-                
-                # Отправляем команду на удалённый хост
-                self._ssh_process.stdin.write(to_bytes(wrapped_command + "\n"))
-                self._ssh_process.stdin.flush()
-                
-                stdout = []
-                stderr = []
-                exit_code = 0
-                
-                # Читаем stdout до маркера
-                while True:
-                    self._check_timeout()
-                    line = self._ssh_process.stdout.readline()
-                    if not line:
-                        display.vvv(f"[winbatch_v3] STDOUT EOF", host=self._play_context.remote_addr)
-                        break
-                    line_text = to_text(line.strip())
-                    display.vvv(f"[winbatch_v3] STDOUT: {line_text}", host=self._play_context.remote_addr)
-                    
-                    # Пропускаем приглашения PS и эхо-команды
-                    if (line_text.startswith('PS ') or 
-                        line_text.startswith('>>') or 
-                        line_text == '' or
-                        'try {' in line_text or
-                        'catch {' in line_text or
-                        'Write-Output' in line_text):
-                        continue
-                        
-                    if line_text.startswith(WINBATCH_V3_MARKER):
-                        try:
-                            exit_code = int(line_text.split(":")[1])
-                        except Exception:
-                            exit_code = 1
-                        break
-                    stdout.append(line_text)
-                
-                # Читаем stderr (только если есть данные, не блокируем)
-                # Не читаем stderr блокирующим способом, чтобы не задерживать результат
-                
-                display.vvv(f"[winbatch_v3] RESULT: rc={exit_code}, stdout={stdout}, stderr={stderr}", host=self._play_context.remote_addr)
-                self._result_queue.put({
+        """Wait for queued command batches and execute them on the remote host."""
+        while not self._timed_out():
+            # Спим до постановки команды или до таймаута плейбука; на -vvv просыпаемся ещё и к статусу
+            timeout = max(0, self._time_left())
+            if self._vvv:
+                timeout = min(timeout, self._status_interval)
+            self._command_event.wait(timeout=timeout)
+            self._command_event.clear()
+            self._maybe_heartbeat()
+            while self._command_queue:
+                commands = self._command_queue.popleft()
+                if commands is None or not self._execute_batch(commands):
+                    return
+
+    def _execute_batch(self, commands):
+        """Run one command batch; return False once the worker must stop."""
+        results = []
+        try:
+            self._check_timeout()
+            self._check_closing()
+
+            # Формируем каждую команду как одну строку для REPL с собственным номером маркера
+            # Заменяем переводы строк на точку с запятой для многострочных команд
+            _tb = to_bytes
+            seqs = []
+            payload = []
+            for command in commands:
+                self._seq += 1
+                seqs.append(self._seq)
+                if self._vvv:
+                    display.vvv(f"[winbatch_v3] EXEC #{self._seq}: {command}", host=self._remote_addr)
+                payload.append(_WRAP_TMPL % (_tb(command.translate(_CMD_TRANS)), self._seq, self._seq))
+
+            # Ставим всю пачку в очередь на отправку: PowerShell выполняет команды подряд без ожидания ответа.
+            # Остаток дописывается в _read_until_marker вперемешку с чтением, иначе при большом выводе
+            # удалённая сторона перестаёт читать stdin и обе стороны блокируются
+            self._stdin_buf += b''.join(payload)
+            self._write_stdin()
+
+            for command, seq in zip(commands, seqs):
+                stdout, stderr, exit_code = self._read_until_marker(seq)
+                if self._vvv:
+                    display.vvv(f"[winbatch_v3] RESULT #{seq}: rc={exit_code}, stdout={stdout}, stderr={stderr}", host=self._remote_addr)
+                results.append({
                     'command': command,
                     'stdout': stdout,
                     'stderr': stderr,
                     'rc': exit_code
                 })
-            except queue.Empty:
-                continue
-            except Exception as e:
-                display.vvv(f"[winbatch_v3] EXCEPTION: {str(e)}", host=self._play_context.remote_addr)
-                self._result_queue.put({
-                    'command': command,
-                    'stdout': [],
-                    'stderr': [str(e)],
-                    'rc': 1
-                })
+            self._result_queue.put((commands, results))
+        except (AnsibleConnectionFailure, OSError) as e:
+            display.vvv(f"[winbatch_v3] EXCEPTION: {str(e)}", host=self._remote_addr)
+            self._put_error_results(commands, results, e)
+            # После таймаута плейбука или закрытия соединения новые команды уже не принимаются
+            if self._closing or isinstance(e, AnsibleConnectionFailure) and self._timed_out():
+                return False
+        except Exception as e:
+            display.warning(f"[winbatch_v3] unexpected error in command worker: {str(e)}")
+            self._put_error_results(commands, results, e)
+        return True
 
-    def _send_status(self):
-        """Send status updates back to AWX every status_interval seconds."""
+    def _read_until_marker(self, seq):
+        """Read SSH output until the end marker of command seq; return (stdout, stderr, rc)."""
+        stdout = []
+        stderr = []
+        rc = err_rc = None
         while True:
+            # Разбираем уже прочитанные полные строки; неполный хвост остаётся в буфере
+            if rc is None:
+                rc = self._scan_lines(self._stdout_buf, seq, stdout, 'STDOUT', is_stdout=True)
+            if err_rc is None and self._stderr_open:
+                err_rc = self._scan_lines(self._stderr_buf, seq, stderr, 'STDERR', is_stdout=False)
+            # Команда завершена, когда маркер пришёл по обоим каналам: так stderr не перетекает к соседней команде
+            if rc is not None and (err_rc is not None or not self._stderr_open):
+                return stdout, stderr, rc
+
+            self._check_timeout()
+            self._check_closing()
+            events = self._selector.select(timeout=self._queue_timeout)
+            self._maybe_heartbeat()
+            for key, _ in events:
+                if key.fd == self._stdin_fd:
+                    self._write_stdin()
+                    continue
+                try:
+                    chunk = os.read(key.fd, _READ_CHUNK)
+                except BlockingIOError:
+                    continue
+                if key.fd == self._stderr_fd:
+                    # stderr вычитываем всегда, иначе ssh заблокируется на переполненном канале
+                    if chunk:
+                        self._stderr_buf += chunk
+                    else:
+                        self._selector.unregister(key.fd)
+                        self._stderr_open = False
+                    continue
+                if not chunk:
+                    display.vvv(f"[winbatch_v3] STDOUT EOF", host=self._remote_addr)
+                    raise AnsibleConnectionFailure("SSH process closed stdout before the command completed")
+                self._stdout_buf += chunk
+
+    def _write_stdin(self):
+        """Write as much pending input as the pipe accepts; watch stdin for writability while input remains."""
+        buf = self._stdin_buf
+        if buf:
             try:
-                time.sleep(1)  # Check more frequently
-                if time.time() - self._last_status_time >= self._status_interval:
-                    self._check_timeout()
-                    status = {
-                        'timestamp': time.time(),
-                        'queue_size': self._command_queue.qsize(),
-                        'connection_active': self._connected,
-                        'elapsed_time': time.time() - self._playbook_start_time,
-                        'timeout': self._playbook_timeout
-                    }
-                    display.vvv(f"Status update: {json.dumps(status)}", host=self._play_context.remote_addr)
-                    self._last_status_time = time.time()
-            except Exception as e:
-                display.vvv(f"Failed to send status update: {str(e)}", host=self._play_context.remote_addr)
+                del buf[:os.write(self._stdin_fd, buf)]
+            except BlockingIOError:
+                pass
+        watched = self._stdin_fd in self._selector.get_map()
+        if buf and not watched:
+            self._selector.register(self._stdin_fd, selectors.EVENT_WRITE)
+        elif not buf and watched:
+            self._selector.unregister(self._stdin_fd)
 
-    def exec_command(self, cmd, in_data=None, sudoable=True):
-        """Execute a command on the remote host."""
+    def _scan_lines(self, buf, seq, lines, stream, is_stdout):
+        """Move complete lines from buf into lines up to the marker of command seq; return its rc or None.
+
+        On stdout the marker starts its line and empty lines are dropped; on stderr the marker
+        may follow unterminated output and every other line is kept as error output.
+        """
+        _tt = to_text
+        rc = None
+        start = 0
+        while True:
+            end = buf.find(b'\n', start)
+            if end < 0:
+                break
+            line = bytes(buf[start:end]).strip()
+            start = end + 1
+            if is_stdout:
+                match = _LINE_RE.search(line)
+                marker = match if match is not None and match.group(1) else None
+            else:
+                match = marker = _ERR_MARKER_RE.search(line)
+            if marker is not None:
+                # Вывод без перевода строки перед маркером - последняя строка результата команды
+                head = line[:marker.start()].rstrip()
+                if head:
+                    lines.append(_tt(head))
+                if marker.group('rc') is not None:
+                    marker_seq, rc = int(marker.group('seq')), int(marker.group('rc'))
+                else:
+                    marker_seq, rc = seq, 1
+                # Маркер более ранней (просроченной) команды: её вывод отбрасываем
+                if marker_seq < seq:
+                    del lines[:]
+                    rc = None
+                    continue
+                break
+
+            if self._vvv:
+                display.vvv(f"[winbatch_v3] {stream}: {_tt(line)}", host=self._remote_addr)
+
+            # Пропускаем пустые строки stdout; декодируем только то, что вернём вызывающему
+            if is_stdout and match is not None:
+                continue
+            lines.append(_tt(line))
+        del buf[:start]
+        return rc
+
+    def _put_error_results(self, commands, results, error):
+        """Fail the commands of a batch that have no result yet and report the batch."""
+        for command in commands[len(results):]:
+            results.append({
+                'command': command,
+                'stdout': [],
+                'stderr': [str(error)],
+                'rc': 1
+            })
+        self._result_queue.put((commands, results))
+
+    def _maybe_heartbeat(self):
+        """Send a status update back to AWX if the status interval has passed (-vvv only)."""
+        if not self._vvv:
+            return
+        now = time.monotonic()
+        if now - self._last_status_time < self._status_interval:
+            return
+        self._last_status_time = now
+        status = {
+            'timestamp': time.time(),
+            'queue_size': len(self._command_queue),
+            'connection_active': self._connected,
+            'elapsed_time': now - self._playbook_start_time,
+            'timeout': self._playbook_timeout
+        }
+        display.vvv(f"Status update: {_JSON_ENC(status)}", host=self._remote_addr)
+
+    def _submit(self, commands):
+        """Queue commands as one batch and wait for their result dicts."""
+        self._command_queue.append(commands)
+        self._command_event.set()
+        deadline = time.monotonic() + self._command_timeout * len(commands)
+        while True:
+            batch, results = self._result_queue.get(timeout=max(0, deadline - time.monotonic()))
+            # Результаты ранее просроченного вызова пропускаем
+            if batch is commands:
+                return results
+
+    def exec_commands(self, cmds):
+        """Execute several commands in one round-trip; return a list of (rc, stdout, stderr)."""
+        cmds = list(cmds)
+        if not cmds:
+            return []
         if not self._connected:
             self._connect()
         try:
             self._check_timeout()
-            display.vvv(f"[winbatch_v3] exec_command: {cmd}", host=self._play_context.remote_addr)
-            self._command_queue.put(cmd)
-            display.vvv(f"[winbatch_v3] waiting for result with timeout {self._command_timeout}", host=self._play_context.remote_addr)
-            result = self._result_queue.get(timeout=self._command_timeout)
-            display.vvv(f"[winbatch_v3] got result: {result}", host=self._play_context.remote_addr)
-            stdout = '\n'.join(result.get('stdout', []))
-            stderr = '\n'.join(result.get('stderr', []))
-            display.vvv(f"[winbatch_v3] exec_command result: rc={result['rc']}, stdout={stdout}, stderr={stderr}", host=self._play_context.remote_addr)
-            return result['rc'], stdout, stderr
+            display.vvv(f"[winbatch_v3] exec_commands: {len(cmds)} command(s)", host=self._remote_addr)
+            display.vvv(f"[winbatch_v3] waiting for results with timeout {self._command_timeout} per command", host=self._remote_addr)
+            results = self._submit(cmds)
+            if self._vvv:
+                display.vvv(f"[winbatch_v3] got results: {results}", host=self._remote_addr)
+            return [
+                (result['rc'], '\n'.join(result.get('stdout', [])), '\n'.join(result.get('stderr', [])))
+                for result in results
+            ]
         except queue.Empty as e:
-            display.vvv(f"[winbatch_v3] exec_command timeout: {str(e)}", host=self._play_context.remote_addr)
+            display.vvv(f"[winbatch_v3] exec_commands timeout: {str(e)}", host=self._remote_addr)
             raise AnsibleConnectionFailure(f"Command execution timeout after {self._command_timeout} seconds: {str(e)}")
         except Exception as e:
-            display.vvv(f"[winbatch_v3] exec_command exception: {str(e)}", host=self._play_context.remote_addr)
+            display.vvv(f"[winbatch_v3] exec_commands exception: {str(e)}", host=self._remote_addr)
             import traceback
-            display.vvv(f"[winbatch_v3] exec_command traceback: {traceback.format_exc()}", host=self._play_context.remote_addr)
+            display.vvv(f"[winbatch_v3] exec_commands traceback: {traceback.format_exc()}", host=self._remote_addr)
             raise AnsibleConnectionFailure(f"Failed to execute command: {str(e)}")
 
+    def exec_command(self, cmd, in_data=None, sudoable=True):
+        """Execute a command on the remote host."""
+        if self._vvv:
+            display.vvv(f"[winbatch_v3] exec_command: {cmd}", host=self._remote_addr)
+        rc, stdout, stderr = self.exec_commands([cmd])[0]
+        if self._vvv:
+            display.vvv(f"[winbatch_v3] exec_command result: rc={rc}, stdout={stdout}, stderr={stderr}", host=self._remote_addr)
+        return rc, stdout, stderr
+
+    @staticmethod
+    def _ps_quote(value):
+        """Quote a string as a PowerShell single-quoted literal."""
+        return "'" + value.replace("'", "''") + "'"
+
+    def _run_transfer(self, commands, action):
+        """Run a batch of transfer commands; raise on the first failed one."""
+        try:
+            results = self._submit(commands)
+        except queue.Empty:
+            raise AnsibleConnectionFailure(f"File {action} timeout after {self._command_timeout} seconds per command")
+        for result in results:
+            if result['rc'] != 0:
+                stderr = '\n'.join(result.get('stderr', []))
+                raise AnsibleConnectionFailure(f"Failed to {action} file: {stderr}")
+        return results
+
+    def _dispose_remote_stream(self):
+        """Queue a best-effort close of the remote transfer stream without waiting for it."""
+        # Рабочий поток уже остановлен - ставить команду некому
+        if self._closing or self._timed_out():
+            return
+        # Dispose встаёт в очередь за просроченной командой и выполнится после неё;
+        # его результат потом пропустит _submit как чужой
+        self._command_queue.append(['if ($wbStream) { $wbStream.Dispose() }'])
+        self._command_event.set()
+
     def put_file(self, in_path, out_path):
         """Transfer a file from local to remote."""
         if not self._connected:
@@ -225,20 +479,25 @@ class Connection(ConnectionBase):
 
         try:
             self._check_timeout()
-            with open(in_path, 'rb') as f:
-                content = f.read()
-
-            # Создаем PowerShell команду для записи файла
-            ps_cmd = f"""
-            $content = [System.Convert]::FromBase64String('{base64.b64encode(content).decode()}')
-            [System.IO.File]::WriteAllBytes('{out_path}', $content)
-            """
-            
-            self._command_queue.put(ps_cmd)
-            result = self._result_queue.get(timeout=self._command_timeout)
-            
-            if result['rc'] != 0:
-                raise AnsibleConnectionFailure(f"Failed to transfer file: {result.get('stderr', [''])[0]}")
+            try:
+                # Открываем файл на удалённой стороне один раз и дописываем его по частям.
+                # Открытие тоже внутри try: просроченный Open всё равно выполнится и оставит эксклюзивный дескриптор
+                self._run_transfer([f"$wbStream = [System.IO.File]::Open({self._ps_quote(out_path)}, 'Create', 'Write')"], 'transfer')
+                window = []
+                with open(in_path, 'rb') as f:
+                    for chunk in iter(lambda: f.read(_TRANSFER_CHUNK), b''):
+                        window.append(
+                            f"$wbBytes = [System.Convert]::FromBase64String('{base64.b64encode(chunk).decode()}'); "
+                            "$wbStream.Write($wbBytes, 0, $wbBytes.Length)"
+                        )
+                        if len(window) == _TRANSFER_WINDOW:
+                            self._run_transfer(window, 'transfer')
+                            window = []
+                window.append('$wbStream.Close()')
+                self._run_transfer(window, 'transfer')
+            except Exception:
+                self._dispose_remote_stream()
+                raise
 
         except Exception as e:
             raise AnsibleConnectionFailure(f"Failed to transfer file: {str(e)}")
@@ -250,21 +509,39 @@ class Connection(ConnectionBase):
 
         try:
             self._check_timeout()
-            # Создаем PowerShell команду для чтения файла
-            ps_cmd = f"""
-            $content = [System.IO.File]::ReadAllBytes('{in_path}')
-            [System.Convert]::ToBase64String($content)
-            """
-            
-            self._command_queue.put(ps_cmd)
-            result = self._result_queue.get(timeout=self._command_timeout)
-            
-            if result['rc'] != 0:
-                raise AnsibleConnectionFailure(f"Failed to fetch file: {result.get('stderr', [''])[0]}")
+            # Пишем во временный файл и атомарно подменяем, чтобы не оставить обрезанный файл
+            tmp_path = f'{out_path}.{os.getpid()}.tmp'
+            try:
+                # Открываем файл на удалённой стороне и узнаём его размер
+                results = self._run_transfer([
+                    f"$wbStream = [System.IO.File]::OpenRead({self._ps_quote(in_path)}); "
+                    f"$wbBuf = New-Object byte[] {_TRANSFER_CHUNK}; $wbStream.Length"
+                ], 'fetch')
+                try:
+                    size = int(results[0]['stdout'][0])
+                except (IndexError, ValueError):
+                    raise AnsibleConnectionFailure(f"Unexpected file size reply: {results[0]['stdout']}")
 
-            # Записываем содержимое в локальный файл
-            with open(out_path, 'wb') as f:
-                f.write(base64.b64decode(result['stdout'][0]))
+                received = 0
+                with open(tmp_path, 'wb') as f:
+                    while received < size:
+                        count = min(_TRANSFER_WINDOW, -(-(size - received) // _TRANSFER_CHUNK))
+                        window = ['$wbRead = $wbStream.Read($wbBuf, 0, $wbBuf.Length); '
+                                  '[System.Convert]::ToBase64String($wbBuf, 0, $wbRead)'] * count
+                        for result in self._run_transfer(window, 'fetch'):
+                            data = base64.b64decode(''.join(result['stdout']))
+                            if not data:
+                                raise AnsibleConnectionFailure(f"Unexpected end of file after {received} of {size} bytes")
+                            f.write(data)
+                            received += len(data)
+                self._run_transfer(['$wbStream.Close()'], 'fetch')
+                os.replace(tmp_path, out_path)
+            except Exception:
+                self._dispose_remote_stream()
+                raise
+            finally:
+                if os.path.exists(tmp_path):
+                    os.unlink(tmp_path)
 
         except Exception as e:
             raise AnsibleConnectionFailure(f"Failed to fetch file: {str(e)}")
@@ -273,16 +550,35 @@ class Connection(ConnectionBase):
         """Close the connection."""
         if self._connected:
             try:
-                # Отправляем сигнал завершения в поток обработки команд
-                self._command_queue.put(None)
+                # Отправляем сигнал завершения в поток обработки команд и ждём его остановки:
+                # поток может быть внутри select(), селектор закрываем только после него
+                self._closing = True
+                self._command_queue.append(None)
+                self._command_event.set()
+                self._command_thread.join(timeout=self._queue_timeout + 1)
+
+                if self._selector:
+                    self._selector.close()
                 
-                # Закрываем SSH процесс
+                # Штатно завершаем удалённый PowerShell, чтобы ssh освободил сессию мастера
                 if self._ssh_process:
-                    self._ssh_process.terminate()
-                    self._ssh_process.wait()
+                    try:
+                        # stdin неблокирующий: если канал забит, просто завершаем процесс
+                        os.write(self._stdin_fd, b'exit\n')
+                        self._ssh_process.stdin.close()
+                        self._ssh_process.wait(timeout=2)
+                    except (OSError, subprocess.TimeoutExpired):
+                        self._ssh_process.terminate()
+                        try:
+                            self._ssh_process.wait(timeout=2)
+                        except subprocess.TimeoutExpired:
+                            self._ssh_process.kill()
+                            self._ssh_process.wait()
+                    for pipe in (self._ssh_process.stdin, self._ssh_process.stdout, self._ssh_process.stderr):
+                        pipe.close()
                 
                 self._connected = False
-                display.vvv("SSH connection closed", host=self._play_context.remote_addr)
+                display.vvv("SSH connection closed", host=self._remote_addr)
                 
             except Exception as e:
-                display.vvv(f"Error while closing connection: {str(e)}", host=self._play_context.remote_addr) 
\ No newline at end of file
+                display.vvv(f"Error while closing connection: {str(e)}", host=self._remote_addr) 
\ No newline at end of file